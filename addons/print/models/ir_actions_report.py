@@ -3,6 +3,14 @@
 from lxml import etree
 from odoo import api, fields, models
 
+# Attributes to be stripped from generated CPCL/XML
+_DATA_ATTRS = etree.XPath("//@*[starts-with(name(), 'data-')]")
+
+# Parser for generated CPCL/XML (preserving whitespace, which may be
+# significant to the printer)
+_CPCL_PARSER = etree.XMLParser(collect_ids=False, huge_tree=True,
+                               resolve_entities=False)
+
 
 class IrActionsReport(models.Model):
     """Add support for CPCL reports"""
@@ -15,10 +23,8 @@ class IrActionsReport(models.Model):
     def render_qweb_cpcl(self, docids, data=None):
         """Render CPCL/XML report"""
         html = self.render_qweb_html(docids, data=data)[0]
-        cpcl = etree.fromstring(html)
-        for element in cpcl.iter():
-            attrs = element.attrib
-            remove = [x for x in attrs if x.startswith('data-')]
-            for attr in remove:
-                del attrs[attr]
-        return (etree.tostring(cpcl, xml_declaration=True), 'cpcl')
+        cpcl = etree.fromstring(html, _CPCL_PARSER)
+        for attr in _DATA_ATTRS(cpcl):
+            del attr.getparent().attrib[attr.attrname]
+        return (etree.tostring(cpcl, xml_declaration=True, encoding='utf-8'),
+                'cpcl')
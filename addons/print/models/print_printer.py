@@ -3,16 +3,37 @@
 import logging
 import os
 import subprocess
-from odoo import api, fields, models
+import threading
+from collections import OrderedDict, defaultdict
+from functools import lru_cache
+from odoo import api, fields, models, tools
 from odoo.tools.translate import _
-from odoo.tools.misc import find_in_path
+from odoo.tools.misc import find_in_path, str2bool
 from odoo.exceptions import UserError, ValidationError
+try:
+    from odoo.addons.queue_job.job import job
+except ImportError:
+    def job(func):
+        """Placeholder job decorator (queue_job not available)"""
+        return func
 
 _logger = logging.getLogger(__name__)
 
+try:
+    import cups
+except ImportError:
+    _logger.debug("Cannot import pycups: printing via lpr")
+    cups = None
 
+# Per-thread cached CUPS connection
+_cups_local = threading.local()
+
+
+@lru_cache(maxsize=1)
 def _find_lpr_exec():
-    """Find usable lpr executable"""
+    """Find usable lpr executable (cached)"""
+    # The location of lpr will not change during the lifetime of the
+    # process; failures raise an exception and so are not cached
     try:
         lpr_exec = find_in_path('lpr')
         return lpr_exec
@@ -20,6 +41,43 @@ def _find_lpr_exec():
         raise UserError(_("Cannot find lpr executable"))
 
 
+def _run_lpr(document, args):
+    """Pipe document into lpr, returning exit status and output"""
+    if _logger.isEnabledFor(logging.INFO):
+        _logger.info("Printing via %s", ' '.join(args))
+    lpr = subprocess.Popen(args, stdin=subprocess.PIPE,
+                           stdout=subprocess.PIPE,
+                           stderr=subprocess.STDOUT)
+    output = lpr.communicate(document)[0]
+    return (lpr.returncode, output)
+
+
+def _cups_connection():
+    """Get CUPS connection (cached per thread)"""
+    conn = getattr(_cups_local, 'connection', None)
+    if conn is None:
+        try:
+            conn = cups.Connection()
+        except RuntimeError as err:
+            raise UserError(_("Cannot connect to CUPS: %s") % err)
+        _cups_local.connection = conn
+    return conn
+
+
+def _cancel_cups_job(job_id):
+    """Cancel partially submitted CUPS job via a fresh connection"""
+    try:
+        _cups_connection().cancelJob(job_id)
+    except (UserError, cups.IPPError, RuntimeError) as err:
+        _logger.warning("Cannot cancel CUPS job %s: %s", job_id, err)
+
+
+def _use_cups():
+    """Check whether to submit documents directly to CUPS"""
+    return (cups is not None and
+            str2bool(tools.config.get('print_use_cups', False), False))
+
+
 class Printer(models.Model):
     """Printer"""
 
@@ -42,8 +100,7 @@ class Printer(models.Model):
                                    string="Report Type", required=True,
                                    default='qweb-pdf')
     user_ids = fields.Many2many('res.users', string="Users")
-    is_default = fields.Boolean(string="System Default", index=True,
-                                default=False)
+    is_default = fields.Boolean(string="System Default", default=False)
     is_user_default = fields.Boolean(string="User Default",
                                      compute='_compute_is_user_default')
     is_ephemeral = fields.Boolean(string="Clear On Logout", default=False)
@@ -66,23 +123,75 @@ class Printer(models.Model):
          "There must be only one System Default Printer per group"),
     ]
 
+    # Registry caches are cleared only when the cached system default
+    # printer (the ungrouped printer with is_default set) may change,
+    # since clearing them discards every cache in every worker
+
+    @api.model
+    def create(self, vals):
+        """Create printer"""
+        printer = super().create(vals)
+        if printer.is_default and not printer.group_id:
+            self.clear_caches()
+        return printer
+
+    @api.multi
+    def write(self, vals):
+        """Write printer"""
+        stale = False
+        if 'is_default' in vals or 'group_id' in vals:
+            # Identify printers that will be ungrouped defaults
+            if 'group_id' in vals:
+                ungrouped = self.browse() if vals['group_id'] else self
+            else:
+                ungrouped = self.filtered(lambda x: not x.group_id)
+            if 'is_default' in vals:
+                defaults = ungrouped if vals['is_default'] else self.browse()
+            else:
+                defaults = ungrouped.filtered(lambda x: x.is_default)
+            stale = (bool(defaults) or
+                     self._system_default_printer_id() in self.ids)
+        res = super().write(vals)
+        if stale:
+            self.clear_caches()
+        return res
+
+    @api.multi
+    def unlink(self):
+        """Delete printer"""
+        stale = self._system_default_printer_id() in self.ids
+        res = super().unlink()
+        if stale:
+            self.clear_caches()
+        return res
+
     @api.multi
     @api.depends('name', 'group_id.full_name')
     def _compute_full_name(self):
         """Calculate full name (including group name(s))"""
-        for printer in self:
-            if printer.group_id.full_name:
-                printer.full_name = '%s / %s' % (
-                    printer.group_id.full_name, printer.name
-                )
+        # Process printers in hierarchy order, so that the full name of
+        # any group within the same batch is reused directly
+        full_names = {}
+        for printer in self.sorted(lambda x: x.parent_left or 0):
+            group = printer.group_id
+            if not group:
+                group_name = None
+            elif group.id in full_names:
+                group_name = full_names[group.id]
             else:
-                printer.full_name = printer.name
+                group_name = group.full_name
+            if group_name:
+                full_name = '%s / %s' % (group_name, printer.name)
+            else:
+                full_name = printer.name
+            printer.full_name = full_names[printer.id] = full_name
 
     @api.multi
     def _compute_is_user_default(self):
         """Calculate user default flag"""
+        user_printer_ids = set(self.env.user.printer_ids.ids)
         for printer in self:
-            printer.is_user_default = printer in self.env.user.printer_ids
+            printer.is_user_default = printer.id in user_printer_ids
 
     @api.multi
     @api.constrains('is_group', 'group_id', 'child_ids')
@@ -96,6 +205,25 @@ class Printer(models.Model):
                 raise ValidationError(_("%s is not a printer group") %
                                       printer.name)
 
+    @api.model
+    @tools.ormcache()
+    def _system_default_printer_id(self):
+        """Get system default printer ID (cached)"""
+        return self.search([('is_default', '=', True),
+                            ('group_id', '=', False)], limit=1).id
+
+    @api.multi
+    def _group_children(self):
+        """Map printer group IDs to child printers"""
+        # Fetch printers within the groups (at any depth) using a
+        # single query on the parent_left/parent_right nested set
+        child_ids = defaultdict(list)
+        for printer in self.search([('id', 'child_of', self.ids)]):
+            child_ids[printer.group_id.id].append(printer.id)
+        return defaultdict(self.browse, {
+            group_id: self.browse(ids) for group_id, ids in child_ids.items()
+        })
+
     @api.multi
     def printers(self, raise_if_not_found=False):
         """Determine printers to use"""
@@ -104,17 +232,28 @@ class Printer(models.Model):
         # back to user's default printer, falling back to system
         # default printer
         printers = (self or self.env.user.printer_id or
-                    self.search([('is_default', '=', True),
-                                 ('group_id', '=', False)]))
+                    self.browse(self._system_default_printer_id()))
 
         # Iteratively reduce any printer groups to their user or
         # system default printers
-        while printers.filtered(lambda x: x.is_group):
-            printers = printers.mapped(lambda p: (
-                p if not p.is_group else
-                ((p.child_ids & self.env.user.printer_ids) or
-                 (p.child_ids.filtered(lambda x: x.is_default)))
-            ))
+        groups = printers.filtered(lambda x: x.is_group)
+        if groups:
+            children = groups._group_children()
+            user_printer_ids = frozenset(self.env.user.printer_ids.ids)
+            reduced = True
+            while reduced:
+                reduced = False
+                ids = []
+                for printer in printers:
+                    if printer.is_group:
+                        reduced = True
+                        grouped = children[printer.id]
+                        printer = (
+                            grouped.filtered(lambda x: x.id in user_printer_ids)
+                            or grouped.filtered(lambda x: x.is_default)
+                        )
+                    ids.extend(printer.ids)
+                printers = self.browse(list(OrderedDict.fromkeys(ids)))
 
         # Fail if no printers were found, if applicable
         if raise_if_not_found and not printers:
@@ -122,42 +261,89 @@ class Printer(models.Model):
 
         return printers
 
+    @api.multi
+    def _spool_queues(self, copies=1):
+        """Determine print queues and total number of copies for each"""
+        # Printers sharing a print queue are combined into a single job
+        queues = OrderedDict()
+        for printer in self:
+            queues[printer.queue] = queues.get(printer.queue, 0) + copies
+        return queues
+
     @api.multi
     def _spool_lpr(self, document, title=None, copies=1):
         """Spool document to printer via lpr"""
         lpr_exec = _find_lpr_exec()
-        for printer in self.printers(raise_if_not_found=True):
+        for queue, count in self._spool_queues(copies).items():
 
             # Construct lpr command line
             args = [lpr_exec]
-            if printer.queue:
-                args += ['-P', printer.queue]
+            if queue:
+                args += ['-P', queue]
             if title is not None:
                 args += ['-T', title]
-            if copies > 1:
-                args += ['-#', str(copies)]
-
-            # Pipe document into lpr
-            _logger.info("Printing via %s", ' '.join(args))
-            lpr = subprocess.Popen(args, stdin=subprocess.PIPE,
-                                   stdout=subprocess.PIPE,
-                                   stderr=subprocess.STDOUT)
-            output = lpr.communicate(document)[0]
-            if lpr.returncode != 0:
+            if count > 1:
+                args += ['-#', str(count)]
+
+            # Pipe document into lpr, stopping at the first failure
+            returncode, output = _run_lpr(document, args)
+            if returncode != 0:
                 raise UserError(_("lpr failed (error code: %s). Message: %s") %
-                                (str(lpr.returncode), output))
+                                (str(returncode), output))
 
     @api.multi
-    def spool(self, document, title=None, copies=1):
-        """Spool document to printer"""
+    def _spool_cups(self, document, title=None, copies=1):
+        """Spool document to printer via CUPS"""
+        conn = _cups_connection()
+        name = title or ''
+        for queue, count in self._spool_queues(copies).items():
+
+            # Submit document directly to CUPS scheduler
+            job_id = None
+            try:
+                dest = queue or conn.getDefault()
+                if not dest:
+                    raise UserError(_("No default CUPS destination"))
+                _logger.info("Printing via CUPS to %s", dest)
+                job_id = conn.createJob(dest, name, {'copies': str(count)})
+                status = conn.startDocument(dest, job_id, name,
+                                            cups.CUPS_FORMAT_AUTO, 1)
+                if status == cups.HTTP_CONTINUE:
+                    status = conn.writeRequestData(document, len(document))
+                if status != cups.HTTP_CONTINUE:
+                    raise UserError(_("CUPS failed (HTTP status: %s)") %
+                                    status)
+                conn.finishDocument(dest)
+            except (cups.IPPError, RuntimeError, UserError) as err:
+                # Discard connection, which may no longer be usable,
+                # and cancel any partially submitted job
+                _cups_local.connection = None
+                if job_id is not None:
+                    _cancel_cups_job(job_id)
+                if isinstance(err, UserError):
+                    raise
+                raise UserError(_("CUPS failed: %s") % (err,))
+
+    @api.multi
+    def _spool_resolved(self, document, title=None, copies=1):
+        """Spool document to printers already resolved via printers()"""
 
         # Spool document via OS-dependent spooler mechanism
         if os.name == 'posix':
-            self._spool_lpr(document, title=title, copies=copies)
+            if _use_cups():
+                self._spool_cups(document, title=title, copies=copies)
+            else:
+                self._spool_lpr(document, title=title, copies=copies)
         else:
             raise UserError(_("Cannot print on OS: %s" % os.name))
         return True
 
+    @api.multi
+    def spool(self, document, title=None, copies=1):
+        """Spool document to printer"""
+        printers = self.printers(raise_if_not_found=True)
+        return printers._spool_resolved(document, title=title, copies=copies)
+
     @api.multi
     def spool_report(self, docids, report_name, data=None, title=None,
                      copies=1):
@@ -170,9 +356,7 @@ class Printer(models.Model):
         else:
             name = report_name
             Report = self.env['ir.actions.report']
-            reports = Report._get_report_from_name(name)
-            if not reports:
-                reports = self.env.ref(name, raise_if_not_found=False)
+            reports = Report.browse(self._report_ids(name))
             if not reports:
                 raise UserError(_("Undefined report %s") % name)
 
@@ -185,37 +369,96 @@ class Printer(models.Model):
             raise UserError(_("Missing reports of types: %s") %
                             ', '.join(missing))
 
-        # Generate reports for each required report type
+        # Generate reports for each required report type, rendering
+        # only a single report of each type
+        selected = {x.report_type: x for x in reports
+                    if x.report_type in required}
         documents = {
-            x.report_type: (
+            report_type: (
                 ("%s %s" % (x.name, str(docids))) if title is None else title,
                 x.render(docids, data)[0]
             )
-            for x in reports if x.report_type in required
+            for report_type, x in selected.items()
         }
 
-        # Send appropriate report to each printer
+        # Send appropriate report to each printer, spooling once per
+        # report type to the already resolved printers
+        printer_ids = defaultdict(list)
         for printer in printers:
-            title, document = documents[printer.report_type]
-            printer.spool(document, title=title, copies=copies)
+            printer_ids[printer.report_type].append(printer.id)
+        for report_type, ids in printer_ids.items():
+            doc_title, document = documents[report_type]
+            printers.browse(ids)._spool_resolved(document, title=doc_title,
+                                                 copies=copies)
 
         return True
 
+    @api.multi
+    def spool_report_async(self, docids, report_name, data=None, title=None,
+                           copies=1):
+        """Spool report to printer in the background, if possible"""
+        # pylint: disable=too-many-arguments
+
+        # Spool via a queue job if queue_job is installed, otherwise
+        # synchronously
+        if hasattr(self, 'with_delay'):
+            self.with_delay()._spool_report_job(docids, report_name,
+                                                data=data, title=title,
+                                                copies=copies)
+            return True
+        return self.spool_report(docids, report_name, data=data,
+                                 title=title, copies=copies)
+
+    # Queue job entry point: this is not intended to be overridden
+    # (override spool_report() instead), since queue_job will refuse
+    # to delay any override that omits the @job decorator
+
+    @job
+    @api.multi
+    def _spool_report_job(self, docids, report_name, data=None, title=None,
+                          copies=1):
+        """Spool report to printer from a queue job"""
+        # pylint: disable=too-many-arguments
+        return self.spool_report(docids, report_name, data=data,
+                                 title=title, copies=copies)
+
+    # Report actions clear the registry caches whenever they are
+    # created, modified or deleted, so cached report IDs stay valid
+
     @api.model
-    def test_page_report(self):
-        """Get printer test pages"""
+    @tools.ormcache('report_name')
+    def _report_ids(self, report_name):
+        """Get report IDs by report name or XML ID (cached)"""
+        Report = self.env['ir.actions.report']
+        reports = Report._get_report_from_name(report_name)
+        if not reports:
+            reports = self.env.ref(report_name, raise_if_not_found=False)
+            if reports is None or reports._name != Report._name:
+                reports = Report
+        return tuple(reports.ids)
+
+    @api.model
+    @tools.ormcache()
+    def _test_page_report_ids(self):
+        """Get printer test page report IDs (cached)"""
         Report = self.env['ir.actions.report']
-        return Report.search([
+        return tuple(Report.search([
             ('model', '=', 'print.printer'),
             ('report_name', '=like', 'print.%'),
-        ])
+        ]).ids)
+
+    @api.model
+    def test_page_report(self):
+        """Get printer test pages"""
+        Report = self.env['ir.actions.report']
+        return Report.browse(self._test_page_report_ids())
 
     @api.multi
     def spool_test_page(self):
         """Print test page"""
+        reports = self.test_page_report()
         for printer in self.printers(raise_if_not_found=True):
-            printer.spool_report(printer.ids, self.test_page_report(),
-                                 title="Test page")
+            printer.spool_report(printer.ids, reports, title="Test page")
         return True
 
     @api.multi
@@ -234,10 +477,10 @@ class Printer(models.Model):
     def set_user_default(self):
         """Set as user default printer (within group, if applicable)"""
         self.ensure_one()
-        self.env.user.printer_ids.filtered(
-            lambda x: x.group_id == self.group_id
-        ).with_env(self.env).clear_user_default()
-        self.env.user.printer_ids += self
+        user = self.env.user
+        user.write({'printer_ids': [
+            (3, x.id) for x in user.printer_ids if x.group_id == self.group_id
+        ] + [(4, self.id)]})
         return {'type': 'ir.actions.client', 'tag': 'reload'}
 
     @api.multi
@@ -246,15 +489,17 @@ class Printer(models.Model):
         self.ensure_one()
         self.search([
             ('is_default', '=', True),
-            ('group_id', '=', self.group_id.id)
-        ]).clear_system_default()
+            ('group_id', '=', self.group_id.id),
+            ('id', '!=', self.id),
+        ]).write({'is_default': False})
         self.is_default = True
         return {'type': 'ir.actions.client', 'tag': 'reload'}
 
     @api.model
     def clear_ephemeral(self):
         """Clear all ephemeral user default printers"""
-        self.env.user.printer_ids.filtered(
-            lambda x: x.is_ephemeral
-        ).with_env(self.env).clear_user_default()
+        user = self.env.user
+        ephemeral = [(3, x.id) for x in user.printer_ids if x.is_ephemeral]
+        if ephemeral:
+            user.write({'printer_ids': ephemeral})
         return {'type': 'ir.actions.client', 'tag': 'reload'}
@@ -27,9 +27,21 @@ class User(models.Model):
     @api.constrains('printer_ids')
     def _check_printer_ids(self):
         """Constrain user to having one default printer per group"""
-        for user in self:
-            groups = set(x.group_id for x in user.printer_ids)
-            if len(user.printer_ids) != len(groups):
-                raise ValidationError(_(
-                    "User may have at most one default printer per group"
-                ))
+
+        # Check all users via a single grouped query on the relation
+        # table, rather than reading every default printer of every
+        # user being checked
+        field = self._fields['printer_ids']
+        self.env.cr.execute("""
+            SELECT rel.{user} FROM {rel} rel
+            JOIN print_printer printer ON printer.id = rel.{printer}
+            WHERE rel.{user} IN %s
+            GROUP BY rel.{user}, printer.group_id
+            HAVING count(*) > 1
+            LIMIT 1
+        """.format(rel=field.relation, user=field.column1,
+                   printer=field.column2), (tuple(self.ids),))
+        if self.env.cr.fetchone():
+            raise ValidationError(_(
+                "User may have at most one default printer per group"
+            ))
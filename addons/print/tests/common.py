@@ -1,8 +1,7 @@
 """Printing tests"""
 
 from psycopg2 import IntegrityError
-from contextlib import contextmanager
-from io import BytesIO
+from contextlib import contextmanager, ExitStack
 import pathlib
 import tempfile
 import sys
@@ -12,11 +11,24 @@ from odoo.modules.module import get_resource_from_path, get_resource_path
 from odoo.tools import config, mute_logger
 from odoo.tools.mimetypes import guess_mimetype
 from odoo.tests import common
+from odoo.addons.print.models import print_printer
 
 MOCK_LPR = 'MOCK_LPR'
 HTML_MIMETYPE = guess_mimetype(b'<html><body></body></html>')
 XML_MIMETYPE = guess_mimetype(b'<?xml version="1.0"/>')
 PDF_MIMETYPE = 'application/pdf'
+XML_PARSER = etree.XMLParser(remove_blank_text=True, collect_ids=False,
+                             resolve_entities=False)
+POPEN_KWARGS = {'stdin': ANY, 'stdout': ANY, 'stderr': ANY}
+
+
+def _xml_equal(a, b):
+    """Check that two XML elements are structurally identical"""
+    return (a.tag == b.tag and a.prefix == b.prefix and a.nsmap == b.nsmap and
+            sorted(a.attrib.items()) == sorted(b.attrib.items()) and
+            (a.text or '') == (b.text or '') and
+            (a.tail or '') == (b.tail or '') and
+            len(a) == len(b) and all(_xml_equal(x, y) for x, y in zip(a, b)))
 
 
 @common.at_install(False)
@@ -24,6 +36,10 @@ PDF_MIMETYPE = 'application/pdf'
 class PrinterCase(common.SavepointCase):
     """Base test case for printing"""
 
+    # Parsed expected CPCL/XML test files, keyed by path and
+    # modification time
+    _expected_cpcl = {}
+
     @classmethod
     def setUpClass(cls):
         super().setUpClass()
@@ -42,24 +58,41 @@ class PrinterCase(common.SavepointCase):
         if path:
             cls.files = pathlib.Path(path)
 
+        # Create mock test_report_directory (shared by all tests) to
+        # ensure that ir.actions.report.render_qweb_pdf() will
+        # actually attempt to generate a PDF
+        cls.tempdir = tempfile.TemporaryDirectory()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tempdir.cleanup()
+        super().tearDownClass()
+
     def setUp(self):
         super().setUp()
+        stack = ExitStack()
+        self.addCleanup(stack.close)
 
         # Patch find_in_path() as used in print_printer.py
-        patch_find_in_path = patch(
+        self.mock_find_in_path = stack.enter_context(patch(
             'odoo.addons.print.models.print_printer.find_in_path',
-            autospec=True, return_value=MOCK_LPR,
-        )
-        self.mock_find_in_path = patch_find_in_path.start()
-        self.addCleanup(patch_find_in_path.stop)
+            return_value=MOCK_LPR,
+        ))
+
+        # Discard any cached lpr executable path
+        print_printer._find_lpr_exec.cache_clear()
+        stack.callback(print_printer._find_lpr_exec.cache_clear)
 
         # Patch subprocess as used in print_printer.py
-        patch_subprocess = patch(
+        self.mock_subprocess = stack.enter_context(patch(
             'odoo.addons.print.models.print_printer.subprocess',
-            autospec=True,
-        )
-        self.mock_subprocess = patch_subprocess.start()
-        self.addCleanup(patch_subprocess.stop)
+            new=Mock(spec=['Popen', 'PIPE', 'STDOUT']),
+        ))
+
+        # Disable direct submission to CUPS
+        stack.enter_context(patch(
+            'odoo.addons.print.models.print_printer.cups', new=None,
+        ))
 
         # Create mock lpr subprocess
         self.mock_lpr = Mock()
@@ -72,38 +105,34 @@ class PrinterCase(common.SavepointCase):
         # prevent ir.actions.report from committing the assets bundle
         # and hence releasing the savepoint.
         #
-        # Create mock test_report_directory to ensure that
-        # ir.actions.report.render_qweb_pdf() will actually attempt to
-        # generate a PDF
+        # Use mock test_report_directory created in setUpClass()
         #
-        self.tempdir = tempfile.TemporaryDirectory()
-        self.addCleanup(self.tempdir.cleanup)
-        patch_config = patch.dict(config.options, {
+        stack.enter_context(patch.dict(config.options, {
             'test_enable': True,
             'test_report_directory': self.tempdir.name,
-        })
-        patch_config.start()
-        self.addCleanup(patch_config.stop)
+        }))
 
     def assertPrintedLpr(self, *args, mimetype='application/pdf'):
         """Assert that ``lpr`` was invoked with the specified argument list"""
-        self.mock_subprocess.Popen.assert_called_once_with(
-            [MOCK_LPR, *args], stdin=ANY, stdout=ANY, stderr=ANY
-        )
-        self.mock_lpr.communicate.assert_called_once()
-        document = self.mock_lpr.communicate.call_args[0][0]
+        popen = self.mock_subprocess.Popen
+        self.assertEqual(popen.call_count, 1)
+        popen_args, popen_kwargs = popen.call_args
+        self.assertEqual(popen_args, ([MOCK_LPR, *args],))
+        self.assertEqual(popen_kwargs.keys(), POPEN_KWARGS.keys())
+        communicate = self.mock_lpr.communicate
+        self.assertEqual(communicate.call_count, 1)
+        document = communicate.call_args[0][0]
         self.assertEqual(guess_mimetype(document), mimetype)
         self.mock_lpr.reset_mock()
         self.mock_subprocess.Popen.reset_mock()
 
     def assertPrintedLprMulti(self, *seq_args):
         """Assert that ``lpr`` was invoked with the sequence of args lists"""
-        def seq_calls():
-            """Generate the sequence of calls expected for ``seq_args``."""
-            for args in seq_args:
-                yield call([MOCK_LPR, *args], stdin=ANY, stdout=ANY, stderr=ANY)
-                yield call().communicate(ANY)
-        self.mock_subprocess.Popen.assert_has_calls(seq_calls())
+        expected = []
+        for args in seq_args:
+            expected.append(call([MOCK_LPR, *args], **POPEN_KWARGS))
+            expected.append(call().communicate(ANY))
+        self.mock_subprocess.Popen.assert_has_calls(expected)
         self.mock_lpr.reset_mock()
         self.mock_subprocess.Popen.reset_mock()
 
@@ -111,18 +140,22 @@ class PrinterCase(common.SavepointCase):
         """Assert that generated CPCL/XML report matches the test file"""
         def canonical(doc):
             """Canonicalize and pretty-print XML document"""
-            with BytesIO() as f:
-                doc.write_c14n(f)
-                compact = etree.fromstring(f.getvalue())
+            compact = etree.fromstring(etree.tostring(doc, method='c14n'))
             return etree.tostring(compact, pretty_print=True).decode()
-        parser = etree.XMLParser(remove_blank_text=True)
         path = self.files.joinpath(filename)
-        expected = canonical(etree.parse(str(path), parser))
-        actual = canonical(etree.ElementTree(etree.fromstring(cpcl, parser)))
+        key = (str(path), path.stat().st_mtime_ns)
+        expected = self._expected_cpcl.get(key)
+        if expected is None:
+            expected = etree.parse(str(path), XML_PARSER).getroot()
+            self._expected_cpcl[key] = expected
+        actual = etree.fromstring(cpcl, XML_PARSER)
+        if _xml_equal(actual, expected):
+            return
+        # Compare canonical forms to decide and to show a readable diff
         try:
             maxDiff = self.maxDiff
             self.maxDiff = None
-            self.assertEqual(actual, expected)
+            self.assertEqual(canonical(actual), canonical(expected))
         finally:
             self.maxDiff = maxDiff
 
@@ -213,17 +246,32 @@ class ActionPrintCase(PrinterCase):
     @property
     def default_report(self):
         """Return the default report"""
-        return self.env.ref('print.action_report_test_page')
+        return self._default_report
 
     @property
     def default_printer(self):
         """Return the default printer"""
-        return self.env.ref('print.default_printer')
+        return self.printer_default
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+
+        # Resolve model ids once: the registry caches (including that
+        # used by ir.model._get_id()) are cleared after every test
+        cls._model_ids = {
+            model: cls.env['ir.model']._get_id(model)
+            for model in (cls.action_model, cls.strategy_model) if model
+        }
+        cls._default_report = cls.env.ref('print.action_report_test_page')
 
     @classmethod
     def model_id(cls, model):
         """Return the model id of `model`."""
-        return cls.env['ir.model']._get_id(model)
+        model_id = cls._model_ids.get(model)
+        if model_id is None:
+            model_id = cls.env['ir.model']._get_id(model)
+        return model_id
 
     def create_action(self, name, model=True):
         """Return a new print action with `name` and print strategy `model`.
@@ -1,12 +1,26 @@
 """Printing tests"""
 
 import os
-from unittest.mock import patch, ANY
-from reportlab.pdfgen.canvas import Canvas
+from contextlib import contextmanager
+from functools import lru_cache
+from unittest.mock import patch, Mock, ANY
 from odoo.exceptions import UserError, ValidationError
+from odoo.tools import config
+from odoo.addons.print.models import print_printer
 from .common import PrinterCase, HTML_MIMETYPE, PDF_MIMETYPE, XML_MIMETYPE
 
 
+@lru_cache(maxsize=1)
+def sample_pdf():
+    """Construct a minimal sample PDF document"""
+    # Import on first use to avoid loading reportlab with the module
+    # pylint: disable=import-outside-toplevel
+    from reportlab.pdfgen.canvas import Canvas
+    canvas = Canvas('')
+    canvas.drawString(100, 750, "Hello world!")
+    return canvas.getpdfdata()
+
+
 class TestPrintPrinter(PrinterCase):
     """Printing tests"""
     # pylint: disable=too-many-public-methods
@@ -55,6 +69,18 @@ class TestPrintPrinter(PrinterCase):
             'login': 'bob',
         })
 
+        # Locate test page report
+        cls.report_test_page = cls.env.ref('print.action_report_test_page')
+
+    def group_printers(self):
+        """Place printers into the upstairs and downstairs groups"""
+        (self.printer_dotmatrix | self.printer_plotter).write({
+            'group_id': self.group_upstairs.id,
+        })
+        (self.printer_laser | self.printer_inkjet).write({
+            'group_id': self.group_downstairs.id,
+        })
+
     def test01_spool_test_page(self):
         """Test printing a test page to unspecified (default) printer"""
         Printer = self.env['print.printer']
@@ -154,9 +180,7 @@ class TestPrintPrinter(PrinterCase):
 
     def test11_untitled(self):
         """Test ability to omit document title"""
-        canvas = Canvas('')
-        canvas.drawString(100, 750, "Hello world!")
-        document = canvas.getpdfdata()
+        document = sample_pdf()
         self.printer_default.spool(document)
         self.assertPrintedLpr()
 
@@ -180,9 +204,7 @@ class TestPrintPrinter(PrinterCase):
 
     def test15_non_pdf(self):
         """Test ability to send non-PDF data to printer"""
-        Report = self.env['ir.actions.report']
-        report = Report._get_report_from_name('print.report_test_page')
-        report.report_type = 'qweb-html'
+        self.report_test_page.report_type = 'qweb-html'
         self.printer_default.report_type = 'qweb-html'
         self.printer_default.spool_test_page()
         self.assertPrintedLpr('-T', ANY, mimetype=HTML_MIMETYPE)
@@ -193,15 +215,14 @@ class TestPrintPrinter(PrinterCase):
         self.printer_dotmatrix.report_type = 'qweb-cpcl'
         xmlid = 'print.action_report_test_page_cpcl'
         self.printer_dotmatrix.spool_report(self.printer_dotmatrix.ids, xmlid)
+        cpcl = self.mock_lpr.communicate.call_args[0][0]
         self.assertPrintedLpr('-P', 'dotmatrix', '-T', ANY,
                               mimetype=XML_MIMETYPE)
-        report = self.env.ref(xmlid)
-        cpcl = report.render(self.printer_dotmatrix.ids)[0]
         self.assertCpclReport(cpcl, 'dotmatrix_test_page.xml')
 
     def test17_spool_by_record(self):
         """Test spooling ir.actions.report record (rather than report name)"""
-        report = self.env.ref('print.action_report_test_page')
+        report = self.report_test_page
         self.printer_default.spool_report(self.printer_default.ids, report)
         self.assertPrintedLpr('-T', ANY)
 
@@ -227,10 +248,7 @@ class TestPrintPrinter(PrinterCase):
 
     def test20_single_per_group(self):
         """Test requirement for user default printer to be unique per group"""
-        self.printer_dotmatrix.group_id = self.group_upstairs
-        self.printer_plotter.group_id = self.group_upstairs
-        self.printer_laser.group_id = self.group_downstairs
-        self.printer_inkjet.group_id = self.group_downstairs
+        self.group_printers()
         self.user_alice.printer_ids = (self.printer_dotmatrix |
                                        self.printer_laser)
         with self.assertRaises(ValidationError):
@@ -240,10 +258,7 @@ class TestPrintPrinter(PrinterCase):
     def test21_system_groups(self):
         """Test selection via printer groups with system defaults"""
         Printer = self.env['print.printer']
-        self.printer_dotmatrix.group_id = self.group_upstairs
-        self.printer_plotter.group_id = self.group_upstairs
-        self.printer_laser.group_id = self.group_downstairs
-        self.printer_inkjet.group_id = self.group_downstairs
+        self.group_printers()
         self.assertFalse(self.group_upstairs.printers())
         self.assertFalse(self.group_downstairs.printers())
         self.printer_dotmatrix.set_system_default()
@@ -263,10 +278,7 @@ class TestPrintPrinter(PrinterCase):
     def test22_user_groups(self):
         """Test selection via printer groups with user defaults"""
         Printer = self.env['print.printer']
-        self.printer_dotmatrix.group_id = self.group_upstairs
-        self.printer_plotter.group_id = self.group_upstairs
-        self.printer_laser.group_id = self.group_downstairs
-        self.printer_inkjet.group_id = self.group_downstairs
+        self.group_printers()
         self.printer_dotmatrix.sudo(self.user_alice).set_user_default()
         self.printer_plotter.sudo(self.user_alice).set_user_default()
         self.printer_inkjet.sudo(self.user_alice).set_user_default()
@@ -324,3 +336,115 @@ class TestPrintPrinter(PrinterCase):
         Printer.sudo(self.user_alice).clear_ephemeral()
         self.assertNotIn(self.printer_dotmatrix, self.user_alice.printer_ids)
         self.assertNotIn(self.user_alice, self.printer_dotmatrix.user_ids)
+
+    def test26_shared_queue(self):
+        """Test combining printers sharing a print queue into a single job"""
+        document = sample_pdf()
+        self.printer_plotter.queue = 'dotmatrix'
+        printers = self.printer_dotmatrix | self.printer_plotter
+        printers.spool(document, title="Shared", copies=3)
+        self.assertPrintedLpr('-P', 'dotmatrix', '-T', "Shared", '-#', '6')
+
+    @contextmanager
+    def patch_cups(self, mock_cups, enabled=True):
+        """Patch in mock CUPS module and connection"""
+        with patch.object(print_printer, 'cups', mock_cups), \
+                patch.object(print_printer._cups_local, 'connection', None,
+                             create=True), \
+                patch.dict(config.options, {'print_use_cups': enabled}):
+            yield
+
+    def test27_cups(self):
+        """Test printing directly via CUPS"""
+        mock_cups = Mock()
+        conn = mock_cups.Connection.return_value
+        conn.createJob.return_value = 42
+        conn.startDocument.return_value = mock_cups.HTTP_CONTINUE
+        conn.writeRequestData.return_value = mock_cups.HTTP_CONTINUE
+        with self.patch_cups(mock_cups):
+            self.printer_dotmatrix.spool(b'%PDF-', title="Direct", copies=2)
+        conn.createJob.assert_called_once_with('dotmatrix', "Direct",
+                                               {'copies': '2'})
+        conn.startDocument.assert_called_once_with(
+            'dotmatrix', 42, "Direct", mock_cups.CUPS_FORMAT_AUTO, 1
+        )
+        conn.writeRequestData.assert_called_once_with(b'%PDF-', 5)
+        conn.finishDocument.assert_called_once_with('dotmatrix')
+        self.mock_subprocess.Popen.assert_not_called()
+
+    def test28_multiple_queues(self):
+        """Test printing to multiple print queues"""
+        printers = self.printer_dotmatrix | self.printer_plotter
+        printers.spool(b'%PDF-', title="Multiple")
+        self.assertPrintedLprMulti(('-P', 'dotmatrix', '-T', "Multiple"),
+                                   ('-P', 'plotter', '-T', "Multiple"))
+
+    def test29_spool_report_async(self):
+        """Test falling back to synchronous spooling without queue_job"""
+        if hasattr(self.printer_dotmatrix, 'with_delay'):
+            self.skipTest("queue_job is installed")
+        self.printer_dotmatrix.spool_report_async(self.printer_dotmatrix.ids,
+                                                  self.report_test_page,
+                                                  title="Background")
+        self.assertPrintedLpr('-P', 'dotmatrix', '-T', "Background")
+
+    def test30_report_cache(self):
+        """Test invalidation of cached report lookups"""
+        Printer = self.env['print.printer']
+        name = 'print.report_test_page_copy'
+        self.assertFalse(Printer._report_ids(name))
+        report = self.report_test_page.copy({'report_name': name})
+        self.assertEqual(Printer._report_ids(name), tuple(report.ids))
+
+    def test31_cups_failure(self):
+        """Test cancelling partially submitted CUPS job on failure"""
+        mock_cups = Mock(IPPError=type('IPPError', (Exception,), {}))
+        conn = mock_cups.Connection.return_value
+        conn.createJob.return_value = 42
+        conn.startDocument.return_value = mock_cups.HTTP_CONTINUE
+        conn.writeRequestData.return_value = mock_cups.HTTP_ERROR
+        with self.patch_cups(mock_cups), self.assertRaises(UserError):
+            self.printer_dotmatrix.spool(b'%PDF-', title="Failed")
+        conn.cancelJob.assert_called_once_with(42)
+        conn.finishDocument.assert_not_called()
+
+    def test32_cups_disabled(self):
+        """Test printing via lpr unless CUPS is explicitly enabled"""
+        mock_cups = Mock()
+        with self.patch_cups(mock_cups, enabled=False):
+            self.printer_dotmatrix.spool(b'%PDF-', title="Indirect")
+        self.assertPrintedLpr('-P', 'dotmatrix', '-T', "Indirect")
+        mock_cups.Connection.assert_not_called()
+
+    def test33_default_cache(self):
+        """Test clearing caches only when system default may change"""
+        Printer = self.env['print.printer']
+        with patch.object(type(Printer), 'clear_caches') as mock_clear:
+            self.group_printers()
+            self.printer_dotmatrix.set_system_default()
+            self.printer_plotter.set_system_default()
+        mock_clear.assert_not_called()
+        self.assertFalse(self.printer_dotmatrix.is_default)
+        self.assertTrue(self.printer_plotter.is_default)
+        self.assertEqual(Printer.printers(), self.printer_default)
+        self.printer_default.group_id = self.group_upstairs
+        self.assertFalse(Printer.printers())
+
+    def test34_spool_report_delayed(self):
+        """Test spooling reports via queue_job"""
+        Printer = self.env['print.printer']
+        with patch.object(type(Printer), 'with_delay',
+                          create=True) as mock_delay:
+            self.printer_dotmatrix.spool_report_async(
+                self.printer_dotmatrix.ids, self.report_test_page,
+                title="Delayed",
+            )
+        mock_delay.return_value._spool_report_job.assert_called_once_with(
+            self.printer_dotmatrix.ids, self.report_test_page, data=None,
+            title="Delayed", copies=1,
+        )
+        self.mock_subprocess.Popen.assert_not_called()
+        self.printer_dotmatrix._spool_report_job(self.printer_dotmatrix.ids,
+                                                 self.report_test_page,
+                                                 title="Delayed")
+        self.assertPrintedLpr('-P', 'dotmatrix', '-T', "Delayed")